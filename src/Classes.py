@@ -1,7 +1,11 @@
-import os, torch, json
+import os, re, time, json, random, hashlib, platform, threading, weakref, torch, psutil
+from functools import partial
+from collections import deque
+import numpy as np
 from bs4 import BeautifulSoup
-from transformers import pipeline,AutoTokenizer, AutoModelForSequenceClassification
+from transformers import pipeline,AutoTokenizer, AutoModel, AutoModelForSequenceClassification
 from matplotlib import pyplot as plt
+from matplotlib import dates as mdates
 import pandas as pd
 
 
@@ -63,6 +67,106 @@ class TgMessage():
         self.contents['sensitive topic'] = self.sensitive_topic
         self.contents['text']=self.text
 
+class Preprocessor:
+    """
+    The Preprocessor normalises the message text once and caches the token ids produced by every tokenizer.
+    - normalise whitespace, strip emoji and replace URLs with a placeholder
+    - tokenize each text only once per tokenizer, models with identical vocabularies share the same ids
+    - store the ids on disk (Cache/tokens/<tokenizer fingerprint>/) so repeat runs skip tokenization
+    """
+    URL_PATTERN = re.compile(r"(https?://|www\.)\S+")
+    EMOJI_PATTERN = re.compile("[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0F\u200D]+")
+    WHITESPACE_PATTERN = re.compile(r"\s+")
+
+    def __init__(self,cache_path:str=None):
+        self.cache_path = cache_path # None disables the on-disk cache
+        self.fingerprints = weakref.WeakKeyDictionary() # tokenizer -> fingerprint, dropped when the tokenizer is freed
+        self.caches = {} # fingerprint -> {text hash: token ids}
+        self.modified = set() # fingerprints with entries not yet saved
+
+    @staticmethod
+    def normalise(text:str)->str:
+        """Replace URLs, remove emoji and collapse whitespace."""
+        text = Preprocessor.URL_PATTERN.sub("URL", text)
+        text = Preprocessor.EMOJI_PATTERN.sub(" ", text)
+        return Preprocessor.WHITESPACE_PATTERN.sub(" ", text).strip()
+
+    @staticmethod
+    def text_key(text:str)->str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def fingerprint(self,tokenizer)->str:
+        """
+        Identifies a tokenizer by its class, vocabulary and special tokens, so two models with the same tokenizer
+        end up in the same cache.
+        """
+        if tokenizer not in self.fingerprints:
+            description = {
+                "class": type(tokenizer).__name__,
+                "vocab": sorted(tokenizer.get_vocab().items()),
+                "special_tokens": tokenizer.special_tokens_map,
+                "lower_case": getattr(tokenizer, "do_lower_case", None),
+            }
+            digest = hashlib.sha1(json.dumps(description, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+            self.fingerprints[tokenizer] = digest
+        return self.fingerprints[tokenizer]
+
+    def load_cache(self,fingerprint:str)->dict:
+        """Loads the cached token ids of one tokenizer from disk, or returns an empty cache."""
+        if fingerprint in self.caches:
+            return self.caches[fingerprint]
+
+        cache = {}
+        if self.cache_path is not None:
+            folder = os.path.join(self.cache_path, fingerprint)
+            keys_path = os.path.join(folder, "keys.json")
+            if os.path.exists(keys_path):
+                with open(keys_path) as f:
+                    keys = json.load(f)
+                # read into memory, a mapped ids.npy could not be replaced by save() on Windows
+                ids = np.load(os.path.join(folder, "ids.npy"))
+                offsets = np.load(os.path.join(folder, "offsets.npy"))
+                for idx, key in enumerate(keys):
+                    cache[key] = ids[offsets[idx]:offsets[idx + 1]]
+        self.caches[fingerprint] = cache
+        return cache
+
+    def encode(self,tokenizer,text:str)->list:
+        """Returns the token ids (special tokens included, not truncated) of the text for the given tokenizer."""
+        fingerprint = self.fingerprint(tokenizer)
+        cache = self.load_cache(fingerprint)
+        key = self.text_key(text)
+        if key not in cache:
+            cache[key] = np.asarray(tokenizer(text, truncation=False, verbose=False)["input_ids"], dtype=np.int32)
+            self.modified.add(fingerprint)
+        return cache[key].tolist()
+
+    def save(self):
+        """Writes every modified cache to disk as one flat id array plus offsets."""
+        if self.cache_path is None:
+            return
+        for fingerprint in self.modified:
+            cache = self.caches[fingerprint]
+            folder = os.path.join(self.cache_path, fingerprint)
+            os.makedirs(folder, exist_ok=True)
+
+            keys = list(cache.keys())
+            arrays = [np.asarray(cache[key], dtype=np.int32) for key in keys]
+            offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(array) for array in arrays])
+            ids = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+
+            # write to temporary files and swap them in, so a crash never leaves a half-written cache
+            np.save(os.path.join(folder, "ids.tmp.npy"), ids)
+            np.save(os.path.join(folder, "offsets.tmp.npy"), offsets)
+            with open(os.path.join(folder, "keys.tmp.json"), "w") as f:
+                json.dump(keys, f)
+            self.caches[fingerprint] = {key: ids[offsets[idx]:offsets[idx + 1]] for idx, key in enumerate(keys)}
+            os.replace(os.path.join(folder, "ids.tmp.npy"), os.path.join(folder, "ids.npy"))
+            os.replace(os.path.join(folder, "offsets.tmp.npy"), os.path.join(folder, "offsets.npy"))
+            os.replace(os.path.join(folder, "keys.tmp.json"), os.path.join(folder, "keys.json"))
+        self.modified.clear()
+
 class Fetcher:
     """
     The Fetcher object be responsible for the following tasks:
@@ -72,9 +176,9 @@ class Fetcher:
     - respect message restriction provided by the user
     """
 
-    def __init__(self,base_path):
+    def __init__(self,base_path,data_folder:str="Data/"):
         self.path = os.path.dirname(__file__)#Where is the Fetcher object called from
-        self.data_path = os.path.join(base_path, "Data/") #searches where the Data is located
+        self.data_path = os.path.join(base_path, data_folder) #searches where the Data is located, one folder per channel in a multi-channel run
         self.texts = []
         self.dates = []
     def read_html(self)->list:
@@ -84,28 +188,32 @@ class Fetcher:
         """
 
         file_name_list = os.listdir(self.data_path) # reads the file names from the data folder
-        html_files = [file for file in file_name_list if file.endswith(".html")] # creates a list with the html files
+        html_files = sorted(file for file in file_name_list if file.endswith(".html")) # creates a list with the html files
 
         if not html_files: # handle no html file found
             print("No html files found")
 
-        for file in html_files: # iterate through each html file
+        bs_messages = []
+        for file in html_files: # iterate through each html file, long exports are split into several files
             file_path = os.path.join(self.data_path,file)
             with open(file_path, 'r', encoding='utf-8') as file:
                 soup = BeautifulSoup(file, 'html.parser')  # create a soup object
 
                 body_divs = soup.find_all('div', class_='body')
-                bs_messages = [div for div in body_divs if div['class'] == ['body']]  # filter body divs, the to-be messages
+                bs_messages.extend(div for div in body_divs if div['class'] == ['body'])  # filter body divs, the to-be messages
 
-                return bs_messages
+        return bs_messages
     def create_messages(self,bs_messages: list,restriction:int)->list:
         """
         The following method transforms bs4 tag objects into Tg_message objects. Returns a list of TgMessage objects.
         """
         message_list = []
         for message in bs_messages:
-            if message.find('div', class_='text') != None:  # if it does not find any texts, then we skip it
-                text = message.find('div', class_='text').get_text().strip()
+            text_div = message.find('div', class_='text')
+            if text_div is not None:  # if it does not find any texts, then we skip it
+                text = Preprocessor.normalise(text_div.get_text())
+                if not text: # messages made only of emoji/whitespace
+                    continue
                 date = message.find('div', class_='pull_right date details').get('title')
 
                 date = date[:10].replace(".","/")
@@ -114,16 +222,108 @@ class Fetcher:
 
         return message_list[:restriction] # add message restriction for better performance
 
+class Channel:
+    """
+    The Channel object keeps the state of one channel in a multi-channel run:
+    - the TgMessage objects to analyse and how many of them were already handed out
+    - the analysis results, in the same format as run_analysis
+    - the time spent on its messages, for the throughput statistics
+    The messages are only fetched when the channel becomes active, and released once it is finished, so the memory
+    use depends on the number of active channels and not on the total number of messages.
+    """
+    def __init__(self,name:str,fetcher:Fetcher,restriction:int,output_dir:str):
+        self.name = name
+        self.fetcher = fetcher
+        self.restriction = restriction
+        self.output_dir = output_dir
+        self.loaded = False
+        self.message_list = None
+        self.message_count = 0
+        self.position = 0
+        self.data = {"Date": [], "Semantic Tag": [], "Label": []}
+        self.index = None
+        self.processing_time = 0.0
+
+    def load(self):
+        """Fetches the messages of the channel. Does nothing if they were already fetched."""
+        if not self.loaded:
+            self.message_list = self.fetcher.create_messages(self.fetcher.read_html(), self.restriction)
+            self.message_count = len(self.message_list)
+            self.loaded = True
+    def release(self):
+        """Frees the messages, results and index of a finished channel, only the statistics are kept."""
+        self.fetcher = None
+        self.message_list = None
+        self.data = None
+        self.index = None
+
+    def next_slice(self,slice_size:int)->tuple:
+        """Hands out the next slice_size messages. Returns (start position, messages)."""
+        start = self.position
+        self.position = min(start + slice_size, self.message_count)
+        return start, self.message_list[start:self.position]
+    def is_done(self)->bool:
+        return self.loaded and self.position >= self.message_count
+    def throughput(self)->float:
+        """Analysed messages per second of model time."""
+        return self.position / self.processing_time if self.processing_time else 0.0
+
+class ChannelScheduler:
+    """
+    The ChannelScheduler decides which channel the shared Analyser works on next.
+    At most max_active channels are in progress at once, and they take turns (round-robin) with slice_size messages
+    each, so one huge channel can't starve the rest. A waiting channel is loaded as soon as an active one is finished.
+    The channels are interleaved in a single thread, the models only ever work on one slice at a time.
+    """
+    def __init__(self,channels:list,max_active:int=4,slice_size:int=16):
+        self.waiting = deque(channels)
+        self.active = deque()
+        self.max_active = max(max_active, 1)
+        self.slice_size = max(slice_size, 1)
+
+    def __iter__(self):
+        """Yields (channel, start position, messages). Channel.is_done() is True after its last slice was yielded."""
+        while self.waiting or self.active:
+            while self.waiting and len(self.active) < self.max_active:
+                channel = self.waiting.popleft()
+                channel.load()
+                if channel.is_done():
+                    print(f"No valid messages found for channel {channel.name}. Skipping it.")
+                    continue
+                self.active.append(channel)
+            if not self.active:
+                break
+            channel = self.active.popleft()
+            start, messages = channel.next_slice(self.slice_size)
+            if not channel.is_done():
+                self.active.append(channel)
+            yield channel, start, messages
+
 class Analyser:
     """
     The Analyser object creates LLM inferences. The outputs are predictions for topic, sentiment, and sensitive topics for the text provided.
+    Token ids are requested from the Preprocessor, so each text is tokenized once per tokenizer.
+    It also creates sentence embeddings, which the EmbeddingIndex uses for semantic search and topic re-labelling.
     """
-    def __init__(self):
+    TOPIC_LABELS = ['Politics', 'Economy', 'Technology', 'Sport', 'Culture', 'Health', 'Entertainment', 'Science',
+                    'Environment', 'World News', 'Local News']
+    SENTIMENT_MODEL = "MonoHime/rubert-base-cased-sentiment-new"
+    TOPIC_MODEL = "MoritzLaurer/mDeBERTa-v3-base-mnli-xnli"
+    SENSITIVE_TOPIC_MODEL = "apanc/russian-sensitive-topics"
+    EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+    MAX_TOPIC_PAIRS = 64 # (text, label) pairs per forward pass of the zero-shot pipeline
+
+    def __init__(self,preprocessor:Preprocessor=None):
+        self.preprocessor = preprocessor if preprocessor is not None else Preprocessor()
         self.sentiment_tokenizer = None
         self.sentiment_analysis_model = None
         self.topic_classifier_model = None
         self.sensitive_topic_tokenizer = None
         self.sensitive_topic_model = None
+        self.embedding_tokenizer = None
+        self.embedding_model = None
+        # Number of messages per inference call, chosen by the Autotuner
+        self.batch_sizes = {"sentiment": 1, "topic": 1, "sensitive_topic": 1, "embedding": 32}
 
         # Load sensitive topic mapping
         project_root = os.getcwd()
@@ -138,15 +338,41 @@ class Analyser:
     # Loads the tokenizer and model for LLM analysis if they are not already loaded. This should spare required compute resources for the text analysis.
     def load_sentiment_model(self):
         if self.sentiment_tokenizer is None or self.sentiment_analysis_model is None:
-            self.sentiment_tokenizer = AutoTokenizer.from_pretrained("MonoHime/rubert-base-cased-sentiment-new")
-            self.sentiment_analysis_model = AutoModelForSequenceClassification.from_pretrained("MonoHime/rubert-base-cased-sentiment-new")
+            self.sentiment_tokenizer = AutoTokenizer.from_pretrained(self.SENTIMENT_MODEL)
+            self.sentiment_analysis_model = AutoModelForSequenceClassification.from_pretrained(self.SENTIMENT_MODEL)
     def load_topic_model(self):
         if self.topic_classifier_model is None:
-            self.topic_classifier_model = pipeline("zero-shot-classification", model="MoritzLaurer/mDeBERTa-v3-base-mnli-xnli")
+            self.topic_classifier_model = pipeline("zero-shot-classification", model=self.TOPIC_MODEL)
     def load_sensitive_topic_model(self):
         if self.sensitive_topic_tokenizer is None or self.sensitive_topic_model is None:
-            self.sensitive_topic_tokenizer = AutoTokenizer.from_pretrained("apanc/russian-sensitive-topics")
-            self.sensitive_topic_model = AutoModelForSequenceClassification.from_pretrained("apanc/russian-sensitive-topics")
+            self.sensitive_topic_tokenizer = AutoTokenizer.from_pretrained(self.SENSITIVE_TOPIC_MODEL)
+            self.sensitive_topic_model = AutoModelForSequenceClassification.from_pretrained(self.SENSITIVE_TOPIC_MODEL)
+    def load_embedding_model(self):
+        if self.embedding_tokenizer is None or self.embedding_model is None:
+            self.embedding_tokenizer = AutoTokenizer.from_pretrained(self.EMBEDDING_MODEL)
+            self.embedding_model = AutoModel.from_pretrained(self.EMBEDDING_MODEL)
+
+    def cached_ids(self,tokenizer,analysed_data:str)->list:
+        """Returns the cached token ids, truncated to the model's maximum length."""
+        ids = self.preprocessor.encode(tokenizer, analysed_data)
+        max_length = min(tokenizer.model_max_length, 512)
+        if len(ids) > max_length:
+            ids = ids[:max_length - 1] + ids[-1:] # keep the closing special token
+        return ids
+    def encode(self,tokenizer,analysed_data:str)->dict:
+        """Builds the model inputs of a single text from the cached token ids."""
+        input_ids = torch.tensor([self.cached_ids(tokenizer, analysed_data)])
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    def encode_batch(self,tokenizer,analysed_data:list)->dict:
+        """Builds the padded model inputs of several texts from the cached token ids."""
+        ids_list = [self.cached_ids(tokenizer, text) for text in analysed_data]
+        width = max(len(ids) for ids in ids_list)
+        input_ids = torch.full((len(ids_list), width), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(ids_list), width), dtype=torch.long)
+        for row, ids in enumerate(ids_list):
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
 
     # create LLM inference
     def sentiment_analysis(self, analysed_data: str) -> str:
@@ -161,7 +387,7 @@ class Analyser:
             str: The predicted sentiment label (Neutral, Positive, or Negative).
         """
         labels = ["Neutral", "Positive", "Negative"]
-        inputs = self.sentiment_tokenizer(analysed_data, padding=True, return_tensors="pt")
+        inputs = self.encode(self.sentiment_tokenizer, analysed_data)
 
         with torch.no_grad():
             outputs = self.sentiment_analysis_model(**inputs)
@@ -185,9 +411,7 @@ class Analyser:
         Returns:
             str: The predicted topic label.
         """
-        possible_labels = ['Politics', 'Economy', 'Technology', 'Sport', 'Culture', 'Health', 'Entertainment', 'Science',
-                           'Environment', 'World News', 'Local News']
-        output = self.topic_classifier_model(analysed_data, possible_labels, multi_label=False)
+        output = self.topic_classifier_model(analysed_data, self.TOPIC_LABELS, multi_label=False)
         return output['labels'][0]
     def classify_sensitive_topic(self, analysed_data: str) -> str:
         """
@@ -200,11 +424,75 @@ class Analyser:
         Returns:
             str: The predicted sensitive topic label.
         """
-        inputs = self.sensitive_topic_tokenizer(analysed_data, return_tensors="pt", truncation=True, padding=True)
+        inputs = self.encode(self.sensitive_topic_tokenizer, analysed_data)
         with torch.no_grad():
             outputs = self.sensitive_topic_model(**inputs)
         predicted_class = torch.argmax(outputs.logits).item()
         return self.target_variables[str(predicted_class)]
+    # batched LLM inference, one call per batch of messages
+    def sentiment_analysis_batch(self, analysed_data: list) -> list:
+        """Same as sentiment_analysis, for a batch of texts."""
+        labels = ["Neutral", "Positive", "Negative"]
+        inputs = self.encode_batch(self.sentiment_tokenizer, analysed_data)
+        with torch.no_grad():
+            outputs = self.sentiment_analysis_model(**inputs)
+        return [labels[predicted_class] for predicted_class in torch.argmax(outputs.logits, dim=1).tolist()]
+    def classify_topic_batch(self, analysed_data: list) -> list:
+        """Same as classify_topic, for a batch of texts."""
+        # the pipeline batches (text, label) pairs, capped so a large batch of long texts can't exhaust the memory
+        outputs = self.topic_classifier_model(analysed_data, self.TOPIC_LABELS, multi_label=False,
+                                              batch_size=min(len(analysed_data) * len(self.TOPIC_LABELS),
+                                                             self.MAX_TOPIC_PAIRS))
+        return [output['labels'][0] for output in outputs]
+    def classify_sensitive_topic_batch(self, analysed_data: list) -> list:
+        """Same as classify_sensitive_topic, for a batch of texts."""
+        inputs = self.encode_batch(self.sensitive_topic_tokenizer, analysed_data)
+        with torch.no_grad():
+            outputs = self.sensitive_topic_model(**inputs)
+        return [self.target_variables[str(predicted_class)] for predicted_class in torch.argmax(outputs.logits, dim=1).tolist()]
+    def pretokenize(self, tokenizer, analysed_data: list):
+        """Fills the token cache for the texts, so later inference calls don't pay for tokenization."""
+        for text in analysed_data:
+            self.preprocessor.encode(tokenizer, text)
+    def loaded_models(self) -> dict:
+        """
+        Returns {batch size key: (model name, batched inference method, pre-tokenization method)} for every model
+        currently loaded. The pre-tokenization method is None for the topic pipeline, which tokenizes internally.
+        """
+        models = {}
+        if self.sentiment_analysis_model is not None:
+            models["sentiment"] = (self.SENTIMENT_MODEL, self.sentiment_analysis_batch,
+                                   partial(self.pretokenize, self.sentiment_tokenizer))
+        if self.topic_classifier_model is not None:
+            models["topic"] = (self.TOPIC_MODEL, self.classify_topic_batch, None)
+        if self.sensitive_topic_model is not None:
+            models["sensitive_topic"] = (self.SENSITIVE_TOPIC_MODEL, self.classify_sensitive_topic_batch,
+                                         partial(self.pretokenize, self.sensitive_topic_tokenizer))
+        if self.embedding_model is not None:
+            models["embedding"] = (self.EMBEDDING_MODEL, self.embed, partial(self.pretokenize, self.embedding_tokenizer))
+        return models
+
+    def embed(self, analysed_data: list) -> np.ndarray:
+        """
+        Creates sentence embeddings (mean pooling of the last hidden state) for a batch of texts.
+
+        Args:
+            analysed_data (list): The texts to be embedded.
+
+        Returns:
+            np.ndarray: One L2-normalised float32 vector per text.
+        """
+        inputs = self.encode_batch(self.embedding_tokenizer, analysed_data)
+        with torch.no_grad():
+            outputs = self.embedding_model(**inputs)
+
+        mask = inputs["attention_mask"].unsqueeze(-1).float()
+        embeddings = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        embeddings = torch.nn.functional.normalize(embeddings, dim=1)
+        return embeddings.numpy()
+    def embed_labels(self, labels: list) -> np.ndarray:
+        """Creates the prototype embedding of every topic label, phrased like the zero-shot hypothesis."""
+        return self.embed([f"This example is {label}." for label in labels])
 
     def clear_models(self):
         """Clear all loaded models from memory."""
@@ -213,6 +501,242 @@ class Analyser:
         self.topic_classifier_model = None
         self.sensitive_topic_tokenizer = None
         self.sensitive_topic_model = None
+        self.embedding_tokenizer = None
+        self.embedding_model = None
+
+class Autotuner:
+    """
+    The Autotuner picks the batch size of every loaded model for this machine.
+    It runs a short probe over a sample of the actual messages with increasing batch sizes, measures messages/sec and
+    the peak RSS of the process, and keeps the fastest batch size that stays under the memory limit.
+    A batch size is skipped if the RSS growth of the previous sizes predicts it would cross the limit, and the probe
+    stops once its time budget is spent. Runs with fewer than min_messages messages keep the default batch sizes.
+    The chosen settings are saved in a json file per machine and model, so later runs skip the probe.
+    """
+    BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64]
+
+    def __init__(self,cache_file:str,memory_limit_mb:float=None,sample_size:int=64,force:bool=False,
+                 min_messages:int=500,time_budget:float=30.0):
+        self.cache_file = cache_file
+        # default limit: 80% of the memory available when the run starts
+        self.memory_limit_mb = memory_limit_mb or psutil.virtual_memory().available / 2**20 * 0.8
+        self.sample_size = sample_size
+        self.force = force # probe again even if settings are cached
+        self.min_messages = min_messages # smaller runs would spend more time probing than analysing
+        self.time_budget = time_budget # seconds of probing per model
+        self.process = psutil.Process()
+
+        self.settings = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self.settings = json.load(f)
+
+    @staticmethod
+    def machine_key()->str:
+        """Identifies the machine by host name, core count and total memory."""
+        total_gb = round(psutil.virtual_memory().total / 2**30)
+        return f"{platform.node()}-{os.cpu_count()}cpu-{total_gb}GB"
+
+    def sample(self,texts:list)->list:
+        """A reproducible random sample of the texts, including the longest one. Every batch size is timed on it."""
+        rng = random.Random(0)
+        sample = rng.sample(texts, min(self.sample_size, len(texts)))
+        longest = max(texts, key=len)
+        if longest not in sample:
+            sample[0] = longest
+        return sorted(sample, key=len, reverse=True)
+
+    def rss_mb(self)->float:
+        return self.process.memory_info().rss / 2**20
+    def measure(self,predict,texts:list,batch_size:int)->tuple:
+        """
+        Runs predict over the texts in batches of batch_size.
+
+        Returns:
+            tuple: (messages/sec, peak RSS in MB during the probe)
+        """
+        peak = [self.rss_mb()]
+        stop = threading.Event()
+        def sample_rss():
+            while not stop.wait(0.01):
+                peak[0] = max(peak[0], self.rss_mb())
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+
+        started = time.perf_counter()
+        for start in range(0, len(texts), batch_size):
+            predict(texts[start:start + batch_size])
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        sampler.join()
+        peak[0] = max(peak[0], self.rss_mb())
+        return len(texts) / elapsed, peak[0]
+
+    def tune(self,model_name:str,predict,texts:list,prepare=None)->int:
+        """
+        Returns the best batch size of a model, from the cache or from a new probe.
+
+        Args:
+            model_name (str): The name of the model, used as cache key.
+            predict: The batched inference method of the model.
+            texts (list): The messages to analyse, the probe uses a sample of them.
+            prepare: Tokenizes the sample before timing starts, so no batch size pays for cache misses. Optional.
+
+        Returns:
+            int: The batch size, or None if there are too few messages to probe and nothing is cached.
+        """
+        machine = self.machine_key()
+        cached = self.settings.get(machine, {}).get(model_name)
+        # the cache stores the memory the batches need on top of the idle process, which depends on the other
+        # models loaded at the time, so it is checked against the current idle RSS
+        if (cached and not self.force and "extra_rss_mb" in cached
+                and self.rss_mb() + cached["extra_rss_mb"] <= self.memory_limit_mb):
+            return cached["batch_size"]
+        if len(texts) < self.min_messages:
+            return None
+
+        sample = self.sample(texts)
+        if prepare is not None:
+            prepare(sample)
+        predict(sample[-1:]) # warm-up, so lazy initialisation is not measured
+
+        idle_rss_mb = self.rss_mb() # RSS with the models loaded and idle
+        best = {"batch_size": 1, "messages_per_sec": 0.0, "extra_rss_mb": 0}
+        slower = 0
+        previous_size, previous_peak = 0, idle_rss_mb
+        last_size, peak_rss_mb = previous_size, previous_peak
+        probe_started = time.perf_counter()
+        for batch_size in self.BATCH_SIZES:
+            if batch_size > len(sample) or time.perf_counter() - probe_started > self.time_budget:
+                break
+            if last_size > previous_size:
+                # RSS grows roughly linearly with the batch size, extrapolate from the last two measurements
+                growth_per_message = max(peak_rss_mb - previous_peak, 0) / (last_size - previous_size)
+                estimated_peak = peak_rss_mb + growth_per_message * (batch_size - last_size)
+                if estimated_peak > self.memory_limit_mb:
+                    print(f"  {model_name}: batch size {batch_size} skipped, estimated peak RSS "
+                          f"{estimated_peak:.0f} MB is over the limit")
+                    break
+
+            # every batch size runs over the same texts, so their throughput can be compared
+            messages_per_sec, measured_peak = self.measure(predict, sample, batch_size)
+            previous_size, previous_peak = last_size, peak_rss_mb
+            last_size, peak_rss_mb = batch_size, measured_peak
+            print(f"  {model_name}: batch size {batch_size}, {messages_per_sec:.2f} messages/sec, "
+                  f"peak RSS {peak_rss_mb:.0f} MB")
+            if peak_rss_mb > self.memory_limit_mb: # larger batches only need more memory
+                break
+            if messages_per_sec > best["messages_per_sec"]:
+                best = {"batch_size": batch_size, "messages_per_sec": round(messages_per_sec, 2),
+                        "extra_rss_mb": round(max(peak_rss_mb - idle_rss_mb, 0))}
+                slower = 0
+            else:
+                slower += 1
+                if slower == 2: # throughput stopped improving
+                    break
+
+        best["memory_limit_mb"] = round(self.memory_limit_mb)
+        self.settings.setdefault(machine, {})[model_name] = best
+        self.save()
+        return best["batch_size"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with open(self.cache_file, "w") as f:
+            json.dump(self.settings, f, indent=4)
+
+class EmbeddingIndex:
+    """
+    The EmbeddingIndex stores one sentence embedding per analysed message, in the same order as the output csv rows.
+    - embeddings.f16: memory-mapped float16 matrix (messages x dimensions)
+    - texts.bin / text_offsets.npy: the utf-8 message texts as one flat file plus byte offsets, only the rows
+      returned by a search are read
+    - meta.json: model name and matrix shape
+    Nearest neighbours are found with an exact dot product search in NumPy, processed in chunks so the matrix never
+    has to be loaded into memory at once.
+    """
+    def __init__(self,index_path:str):
+        self.index_path = index_path
+        self.matrix_path = os.path.join(index_path, "embeddings.f16")
+        self.meta_path = os.path.join(index_path, "meta.json")
+        self.texts_path = os.path.join(index_path, "texts.bin")
+        self.text_offsets_path = os.path.join(index_path, "text_offsets.npy")
+        self.embeddings = None
+        self.text_offsets = None
+        self.meta = {}
+
+    def create(self,count:int,dim:int,model_name:str,texts:list):
+        """Allocates the memory-mapped matrix for count embeddings of size dim and writes the message texts."""
+        os.makedirs(self.index_path, exist_ok=True)
+        # meta.json is only written by close(), an index that was never completed is reported as not found
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        self.meta = {"model": model_name, "count": count, "dim": dim}
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        with open(self.texts_path, "wb") as f:
+            for idx, text in enumerate(texts):
+                encoded = text.encode("utf-8")
+                f.write(encoded)
+                offsets[idx + 1] = offsets[idx] + len(encoded)
+        np.save(self.text_offsets_path, offsets)
+
+        self.embeddings = np.memmap(self.matrix_path, dtype=np.float16, mode='w+', shape=(count, dim))
+    def add(self,start:int,vectors:np.ndarray):
+        self.embeddings[start:start + len(vectors)] = vectors.astype(np.float16)
+    def close(self):
+        """Flushes the matrix and writes the metadata."""
+        self.embeddings.flush()
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, ensure_ascii=False)
+    def load(self)->bool:
+        """Opens an existing index read-only. Returns False if no index was found."""
+        paths = [self.meta_path, self.matrix_path, self.texts_path, self.text_offsets_path]
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        with open(self.meta_path, encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.embeddings = np.memmap(self.matrix_path, dtype=np.float16, mode='r',
+                                    shape=(self.meta["count"], self.meta["dim"]))
+        self.text_offsets = np.load(self.text_offsets_path, mmap_mode='r')
+        return True
+    def text(self,row:int)->str:
+        """Reads the text of one message from disk."""
+        start, end = int(self.text_offsets[row]), int(self.text_offsets[row + 1])
+        with open(self.texts_path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start).decode("utf-8")
+
+    def similarities(self,queries:np.ndarray,chunk_size:int=65536):
+        """Yields (start row, similarity matrix) chunks of the stored embeddings against the query vectors."""
+        queries = np.atleast_2d(queries).astype(np.float32)
+        for start in range(0, len(self.embeddings), chunk_size):
+            chunk = np.asarray(self.embeddings[start:start + chunk_size], dtype=np.float32)
+            yield start, chunk @ queries.T
+    def search(self,query:np.ndarray,k:int=5)->tuple:
+        """
+        Finds the k messages closest to the query vector.
+
+        Returns:
+            tuple: (row indices, cosine similarities), best match first.
+        """
+        best_rows = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        for start, scores in self.similarities(query):
+            scores = scores[:, 0]
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+            best_rows = np.concatenate([best_rows, top + start])
+            best_scores = np.concatenate([best_scores, scores[top]])
+            keep = np.argsort(-best_scores)[:k]
+            best_rows, best_scores = best_rows[keep], best_scores[keep]
+        return best_rows, best_scores
+    def assign_labels(self,prototypes:np.ndarray,labels:list)->list:
+        """Assigns every message the label whose prototype embedding is the most similar."""
+        assigned = []
+        for _, scores in self.similarities(prototypes):
+            assigned.extend(labels[idx] for idx in scores.argmax(axis=1))
+        return assigned
 
 # to-be implemented
 class Filter:
@@ -229,6 +753,98 @@ class Filter:
         filtered_by_topic = data[data["Label"].str.contains(user_topic,case=False)]
         return filtered_by_topic
 
+class Aggregator:
+    """
+    The Aggregator reduces the csv output to time buckets (day, week or month) without loading the whole file.
+    The file is read in chunks, every chunk is reduced to per-bucket sums and counts, and the partial results are added
+    up. Memory use and the number of plotted points depend on the number of buckets, not on the number of messages.
+    """
+    SEMANTIC_MAP = {'Negative': -1, 'Neutral': 0, 'Positive': 1}
+    FREQUENCY_NAMES = {'D': 'daily', 'W': 'weekly', 'M': 'monthly'}
+    RANGE_FREQUENCIES = {'D': 'D', 'W': 'W-MON', 'M': 'MS'} # pandas frequency of the bucket start dates
+
+    def __init__(self,csv_path:str,sep:str="|",chunk_size:int=100000,max_buckets:int=120):
+        self.csv_path = csv_path
+        self.sep = sep
+        self.chunk_size = chunk_size
+        self.max_buckets = max_buckets
+
+    @staticmethod
+    def parse_dates(dates:pd.Series)->pd.Series:
+        return pd.to_datetime(dates, format='%d/%m/%Y')
+    @staticmethod
+    def choose_frequency(start,end,max_buckets:int=120)->str:
+        """Picks the finest resolution (day, week, month) that keeps the number of buckets under max_buckets."""
+        days = (end - start).days + 1
+        if days <= max_buckets:
+            return 'D'
+        if days / 7 <= max_buckets:
+            return 'W'
+        return 'M'
+    @staticmethod
+    def bucket_frame(data:pd.DataFrame,frequency:str)->dict:
+        """Reduces a DataFrame (or a chunk of the csv) to the semantic sum and the topic counts of every bucket."""
+        buckets = Aggregator.parse_dates(data['Date']).dt.to_period(frequency).dt.start_time
+        partial = {}
+        if 'Semantic Tag' in data.columns:
+            partial['semantic'] = data['Semantic Tag'].map(Aggregator.SEMANTIC_MAP).groupby(buckets).sum()
+        if 'Label' in data.columns:
+            partial['topics'] = pd.crosstab(buckets, data['Label'])
+        return partial
+    @staticmethod
+    def combine(total:dict,partial:dict)->dict:
+        for key, value in partial.items():
+            total[key] = total[key].add(value, fill_value=0) if key in total else value
+        return total
+    @staticmethod
+    def complete(total:dict,start,end,frequency:str)->dict:
+        """Adds the empty buckets, so the x-axis covers the whole date span."""
+        full_range = pd.date_range(start=pd.Timestamp(start).to_period(frequency).start_time,
+                                   end=pd.Timestamp(end).to_period(frequency).start_time,
+                                   freq=Aggregator.RANGE_FREQUENCIES[frequency])
+        aggregation = {"frequency": frequency, "start": start, "end": end}
+        aggregation['semantic'] = total.get('semantic', pd.Series(dtype=float)).reindex(full_range, fill_value=0)
+        aggregation['topics'] = total.get('topics', pd.DataFrame()).reindex(full_range, fill_value=0)
+        return aggregation
+
+    def read_chunks(self,columns:list):
+        return pd.read_csv(self.csv_path, sep=self.sep, usecols=columns, chunksize=self.chunk_size)
+    def aggregate(self,frequency:str=None)->dict:
+        """
+        Aggregates the csv output in two passes: the first finds the date span, the second fills the buckets.
+
+        Args:
+            frequency (str): 'D', 'W' or 'M'. Chosen from the date span if not provided.
+
+        Returns:
+            dict: 'frequency', 'start', 'end', 'semantic' (pd.Series of semantic sums) and 'topics'
+                  (pd.DataFrame of topic counts), both indexed by bucket start date. Empty if the csv has no rows.
+        """
+        start = end = None
+        for chunk in self.read_chunks(['Date']):
+            if chunk.empty:
+                continue
+            dates = self.parse_dates(chunk['Date'])
+            start = dates.min() if start is None else min(start, dates.min())
+            end = dates.max() if end is None else max(end, dates.max())
+        if start is None:
+            return {}
+
+        frequency = frequency or self.choose_frequency(start, end, self.max_buckets)
+        total = {}
+        for chunk in self.read_chunks(lambda column: column in ('Date', 'Semantic Tag', 'Label')):
+            self.combine(total, self.bucket_frame(chunk, frequency))
+        return self.complete(total, start, end, frequency)
+    @staticmethod
+    def aggregate_frame(data:pd.DataFrame,frequency:str=None,max_buckets:int=120)->dict:
+        """Same as aggregate, for a DataFrame that is already in memory."""
+        if data.empty:
+            return {}
+        dates = Aggregator.parse_dates(data['Date'])
+        start, end = dates.min(), dates.max()
+        frequency = frequency or Aggregator.choose_frequency(start, end, max_buckets)
+        return Aggregator.complete(Aggregator.bucket_frame(data, frequency), start, end, frequency)
+
 class Displayer:
     """
     The Displayer generates the data in the output folder. Using the provided data, a pd.DataFrame, it can generate a
@@ -275,73 +891,69 @@ class Displayer:
             return []
 
     # Visualising the Data
-    def create_general_timeline(self, data: pd.DataFrame) -> plt:
+    def format_date_axis(self):
+        """Lets matplotlib choose a readable number of date ticks instead of one tick per day."""
+        locator = mdates.AutoDateLocator()
+        axis = plt.gca().xaxis
+        axis.set_major_locator(locator)
+        axis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+        plt.xticks(rotation=45)
+    def create_general_timeline(self, data: pd.DataFrame, aggregation: dict = None) -> plt:
         """
-            Create a timeline plot showing the dynamic sum of daily semantic tags.
+            Create a timeline plot showing the dynamic sum of semantic tags per day, week or month.
 
             Parameters:
             - data (pd.DataFrame): A DataFrame containing 'Date' and 'Semantic Tag' columns.
+            - aggregation (dict): The output of Aggregator.aggregate. Computed from data if not provided.
             """
-        semantic_map = {'Negative': -1, 'Neutral': 0, 'Positive': 1}
-        data['Semantic Value'] = data['Semantic Tag'].map(semantic_map)
-
-
-        data['Date'] = pd.to_datetime(data['Date'], format='%d/%m/%Y')
-
-        # Group by date and sum the semantic values for each day
-        daily_semantic_sum = data.groupby('Date')['Semantic Value'].sum().reset_index() #use reset_index to convert the date into a column
-
-        # Ensure the x-axis includes all dates, even if no data is available for some messages
-        full_date_range = pd.date_range(start=daily_semantic_sum['Date'].min(),
-                                        end=daily_semantic_sum['Date'].max())
-        daily_semantic_sum = daily_semantic_sum.set_index('Date').reindex(full_date_range, fill_value=0).reset_index()
-        daily_semantic_sum.columns = ['Date', 'Semantic Value']
+        if aggregation is None:
+            aggregation = Aggregator.aggregate_frame(data)
+        semantic_sum = aggregation['semantic']
 
         # Plot the data
         plt.figure(figsize=(15, 5)) #resolution of the plot
-        plt.plot(daily_semantic_sum['Date'], daily_semantic_sum['Semantic Value'], marker='o')
-        plt.title('Semantic Tag Timeline')
+        plt.plot(semantic_sum.index, semantic_sum.values, marker='o' if len(semantic_sum) <= 60 else None)
+        plt.title(f"Semantic Tag Timeline ({Aggregator.FREQUENCY_NAMES[aggregation['frequency']]})")
         plt.xlabel('Date')
         plt.ylabel('Total Semantic Tag')
         plt.grid() #create sick grid look for the graph
-        plt.xticks(daily_semantic_sum['Date'], rotation=45) #customize labels on the x-axis
+        self.format_date_axis() #customize labels on the x-axis
         plt.tight_layout() # squish the labels and title
         return plt
-    def create_topic_dynamics_timeline(self,topic_list: list, data: pd.DataFrame) -> plt:
+    def create_topic_dynamics_timeline(self,topic_list: list, data: pd.DataFrame, aggregation: dict = None) -> plt:
         """
-        Creates a timeline showing the topic frequency dynamics, ensuring all dates are included.
+        Creates a timeline showing the topic frequency dynamics per day, week or month, ensuring all dates are included.
+        Every topic gets one point per bucket, sized by the number of messages.
 
         Args:
             data (pd.DataFrame): The dataset containing the 'Date' and 'Label' columns.
             topic_list (list): The list of topics to include, each assigned a numeric ID.
+            aggregation (dict): The output of Aggregator.aggregate. Computed from data if not provided.
 
         Returns:
             plt: The matplotlib plot object.
         """
         try:
-            # Ensure required columns exist
-            if "Date" not in data.columns or "Label" not in data.columns:
-                raise KeyError("The dataset must contain 'Date' and 'Label' columns.")
-
-            # Assign numeric IDs to topics, so they can be displayed on the y-axis
-            topic_map = {topic: idx + 1 for idx, topic in enumerate(topic_list)}
-            data['Topic ID'] = data['Label'].map(topic_map)
-
-            # Convert 'Date' to datetime format
-            data['Date'] = pd.to_datetime(data['Date'], format='%d/%m/%Y')
+            if aggregation is None:
+                # Ensure required columns exist
+                if "Date" not in data.columns or "Label" not in data.columns:
+                    raise KeyError("The dataset must contain 'Date' and 'Label' columns.")
+                aggregation = Aggregator.aggregate_frame(data)
 
-            # Generate a full date range from the dataset
-            full_date_range = pd.date_range(start=data['Date'].min(), end=data['Date'].max())
+            topic_counts = aggregation['topics'].reindex(columns=topic_list, fill_value=0)
+            largest_count = max(topic_counts.values.max(), 1)
 
-            # Plot the timeline
+            # Plot the timeline, topics get numeric IDs so they can be displayed on the y-axis
             plt.figure(figsize=(16, 10))
-            for topic, topic_id in topic_map.items():
-                topic_data = data[data['Topic ID'] == topic_id]
-                plt.scatter(topic_data['Date'], topic_data['Topic ID'], label=topic, s=50)
+            for topic_id, topic in enumerate(topic_list, start=1):
+                counts = topic_counts[topic]
+                counts = counts[counts > 0]
+                plt.scatter(counts.index, [topic_id] * len(counts), label=topic,
+                            s=10 + 190 * counts.values / largest_count)
 
-            plt.xticks(full_date_range, rotation=45)
+            self.format_date_axis()
             plt.yticks(range(1, len(topic_list) + 1), topic_list)
-            plt.title("Topic Timeline")
+            plt.title(f"Topic Timeline ({Aggregator.FREQUENCY_NAMES[aggregation['frequency']]})")
             plt.xlabel("Date")
             plt.ylabel("Topics")
             plt.grid(True)
@@ -1,3 +1,3 @@
-from Classes import Tg_Message, Fetcher, Analyser
+from Classes import Tg_Message, Fetcher, Analyser, Preprocessor
 
-__all__ = ['Fetcher', 'Analyser', 'Tg_Message']
\ No newline at end of file
+__all__ = ['Fetcher', 'Analyser', 'Tg_Message', 'Preprocessor']
\ No newline at end of file
@@ -1,7 +1,9 @@
 import argparse
 import os
+import time
 import pandas as pd
-from Classes import Fetcher, Analyser, Displayer, Filter
+from matplotlib import pyplot as plt
+from Classes import Fetcher, Analyser, Displayer, Filter, Preprocessor, EmbeddingIndex, Aggregator, Channel, ChannelScheduler, Autotuner
 
 
 def show_sick_banner():
@@ -21,12 +23,24 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Text Analysis CLI using LLMs.")
 
     # Subcommands for 'run' and 'visualize'
-    subparsers = parser.add_subparsers(dest='command', help="Command to execute (run or visualize)")
+    subparsers = parser.add_subparsers(dest='command', help="Command to execute (run, visualize, search or relabel)")
 
     # 'run' subcommand
     run_parser = subparsers.add_parser('run', help='Run the analysis on all HTML files in the Data folder.')
     run_parser.add_argument("-re", "--restriction", type=int, default=-1,
                             help="Number of messages to analyze. Use -1 for all messages.")
+    run_parser.add_argument("-ch", "--channels", type=str,
+                            help="Folder with one subfolder of HTML files per channel. Analyses every channel and "
+                                 "saves the results in Output/<channel>.")
+    run_parser.add_argument("-mc", "--max_channels", type=int, default=4,
+                            help="Number of channels interleaved through the shared models in a multi-channel run.")
+    run_parser.add_argument("-sl", "--slice_size", type=int, default=16,
+                            help="Number of messages a channel analyses before the next channel takes its turn.")
+    run_parser.add_argument("-at", "--autotune", type=str, choices=['cached', 'force', 'off'], default='cached',
+                            help="Probe the best batch size of every model: 'cached' reuses the settings saved for "
+                                 "this machine, 'force' probes again, 'off' uses the default batch sizes.")
+    run_parser.add_argument("-ml", "--memory_limit", type=float,
+                            help="Memory ceiling in MB for the batch size probe. Default: 80%% of the available memory.")
 
     # 'visualize' subcommand
     visualize_parser = subparsers.add_parser('visualize', help='Visualize the analysis output.')
@@ -42,11 +56,55 @@ def parse_args():
                                   help='Create a topic histogram for a specific topic.')
     visualize_parser.add_argument('-tfh', '--topic_frequency_hist', action='store_true',
                                   help='Create a topic frequency histogram from the csv output.')
+    visualize_parser.add_argument('-ch', '--channel', type=str,
+                                  help='Use the output of a channel from a multi-channel run.')
+
+    # 'search' subcommand
+    search_parser = subparsers.add_parser('search', help='Find the messages closest in meaning to a query.')
+    search_parser.add_argument('query', type=str, help='The text to search for.')
+    search_parser.add_argument('-k', '--top', type=int, default=5, help='Number of messages to show.')
+    search_parser.add_argument('-ch', '--channel', type=str, help='Search the output of a channel from a multi-channel run.')
+
+    # 'relabel' subcommand
+    relabel_parser = subparsers.add_parser('relabel',
+                                           help='Reassign the topics of the csv output using the saved embeddings.')
+    relabel_parser.add_argument('-l', '--labels', type=str, nargs='+', default=Analyser.TOPIC_LABELS,
+                                help='The new list of topics. Defaults to the topics of the classifier.')
+    relabel_parser.add_argument('-ch', '--channel', type=str,
+                                help='Relabel the output of a channel from a multi-channel run.')
 
     return parser.parse_args()
 
 # Assign actions and logic to the CLI commands
-def run_analysis(restriction: int) -> pd.DataFrame:
+def create_autotuner(args) -> Autotuner:
+    """Creates the Autotuner for the 'run' command, or None if autotuning is turned off."""
+    if args.autotune == 'off':
+        return None
+    return Autotuner(os.path.join(os.getcwd(), "Cache", "autotune.json"), memory_limit_mb=args.memory_limit,
+                     force=args.autotune == 'force')
+def autotune_models(analyser: Analyser, autotuner: Autotuner, texts: list) -> dict:
+    """
+    Sets the batch size of every loaded model, probing it on a sample of the texts if it is not cached.
+
+    Returns:
+        dict: The batch sizes chosen by the autotuner. Models without one keep their default batch size.
+    """
+    tuned = {}
+    if autotuner is None:
+        return tuned
+    for key, (model_name, predict, prepare) in analyser.loaded_models().items():
+        batch_size = autotuner.tune(model_name, predict, texts, prepare)
+        if batch_size is None:
+            print(f"Too few messages to probe {model_name}, using the default batch size.")
+            continue
+        analyser.batch_sizes[key] = tuned[key] = batch_size
+        print(f"Batch size for {model_name}: {batch_size}")
+    return tuned
+def iterate_batches(items: list, batch_size: int):
+    """Yields (start position, batch) over the items."""
+    for start in range(0, len(items), batch_size):
+        yield start, items[start:start + batch_size]
+def run_analysis(restriction: int, autotuner: Autotuner = None) -> pd.DataFrame:
     """
     Executes the main analysis logic, including fetching messages,
     performing sentiment analysis, and classifying topics.
@@ -56,6 +114,7 @@ def run_analysis(restriction: int) -> pd.DataFrame:
 
     Args:
         restriction (int): The maximum number of messages to process. Use -1 for no restriction.
+        autotuner (Autotuner, optional): Chooses the batch size of each model. Default batch sizes are used if None.
 
     Returns:
         pd.DataFrame: A DataFrame containing the processed data with columns:
@@ -65,7 +124,8 @@ def run_analysis(restriction: int) -> pd.DataFrame:
                       - Sensitive Topic(currently not implemented)
     """
     fetcher = Fetcher(os.getcwd())
-    analyser = Analyser()
+    preprocessor = Preprocessor(os.path.join(os.getcwd(), "Cache", "tokens")) # token ids are reused across runs
+    analyser = Analyser(preprocessor)
 
     # Fetch and process messages directly using Fetcher
     bs_messages = fetcher.read_html()
@@ -88,27 +148,152 @@ def run_analysis(restriction: int) -> pd.DataFrame:
         "Label": [],
     }
 
+    texts = [message.text for message in message_list]
+
     # Perform sentiment analysis
     analyser.load_sentiment_model()
-    for message in message_list:
-        sentiment = analyser.sentiment_analysis(message.text)
-        message.assign_sentiment(sentiment)
-        data["Date"].append(message.date)
-        data["Semantic Tag"].append(message.sentiment)
+    autotune_models(analyser, autotuner, texts)
+    for _, batch in iterate_batches(message_list, analyser.batch_sizes["sentiment"]):
+        sentiments = analyser.sentiment_analysis_batch([message.text for message in batch])
+        for message, sentiment in zip(batch, sentiments):
+            message.assign_sentiment(sentiment)
+            data["Date"].append(message.date)
+            data["Semantic Tag"].append(message.sentiment)
+    preprocessor.save()
     analyser.clear_models()
     print("Semantic analysis completed.")
 
     # Perform topic analysis
     analyser.load_topic_model()
-    for message in message_list:
-        topic = analyser.classify_topic(message.text)
-        message.assign_topic(topic)
-        data["Label"].append(message.topic)
+    autotune_models(analyser, autotuner, texts)
+    for _, batch in iterate_batches(message_list, analyser.batch_sizes["topic"]):
+        topics = analyser.classify_topic_batch([message.text for message in batch])
+        for message, topic in zip(batch, topics):
+            message.assign_topic(topic)
+            data["Label"].append(message.topic)
     analyser.clear_models()
     print("Topic analysis completed.")
 
+    # Save the sentence embeddings, so the data can be searched and re-labelled without a new analysis
+    analyser.load_embedding_model()
+    autotune_models(analyser, autotuner, texts)
+    index = EmbeddingIndex(os.path.join(os.getcwd(), "Output", "embeddings"))
+    index.create(len(message_list), analyser.embedding_model.config.hidden_size, Analyser.EMBEDDING_MODEL, texts)
+    for start, batch in iterate_batches(texts, analyser.batch_sizes["embedding"]):
+        index.add(start, analyser.embed(batch))
+    index.close()
+    preprocessor.save()
+    analyser.clear_models()
+    print("Embedding index completed.")
+
     print("Analysis completed.")
     return pd.DataFrame(data)
+def run_channels(channels_dir: str, restriction: int, max_channels: int, slice_size: int, autotuner: Autotuner = None):
+    """
+    Analyses several channels with one shared set of models.
+
+    Every subfolder of channels_dir is a channel. The models are loaded once, and the ChannelScheduler hands out
+    slices of messages from at most max_channels channels in turn (interleaved in one process, not run in parallel).
+    A channel's messages are only fetched when it becomes active. As soon as a channel is finished, its output.csv,
+    embedding index and graphs are saved in Output/<channel> and its messages are released.
+
+    Args:
+        channels_dir (str): Folder with one subfolder of HTML files per channel.
+        restriction (int): The maximum number of messages to process per channel. Use -1 for no restriction.
+        max_channels (int): Number of channels interleaved at the same time.
+        slice_size (int): Number of messages analysed per turn.
+        autotuner (Autotuner, optional): Chooses the batch size of each model. Default batch sizes are used if None.
+    """
+    if not os.path.isdir(channels_dir):
+        print(f"Channels folder not found: {channels_dir}")
+        return
+    channel_names = sorted(name for name in os.listdir(channels_dir) if os.path.isdir(os.path.join(channels_dir, name)))
+
+    if not channel_names:
+        print("No channels to analyse. Exiting.")
+        return
+    channels = [Channel(name, Fetcher(channels_dir, name), restriction, os.path.join(os.getcwd(), "Output", name))
+                for name in channel_names]
+    print(f"Found {len(channels)} channels. Commencing LLM analysis.")
+
+    # Every model is loaded once and shared by all the channels
+    preprocessor = Preprocessor(os.path.join(os.getcwd(), "Cache", "tokens"))
+    analyser = Analyser(preprocessor)
+    analyser.load_sentiment_model()
+    analyser.load_topic_model()
+    analyser.load_embedding_model()
+    # the autotuner samples the messages of the first channels to become active
+    for channel in channels[:max(max_channels, 1)]:
+        channel.load()
+    sample_texts = [message.text for channel in channels if channel.loaded for message in channel.message_list]
+    tuned = autotune_models(analyser, autotuner, sample_texts) if sample_texts else {}
+    del sample_texts
+    # slices are split into model batches, only raise the slice size so a turn can fill a tuned batch
+    if tuned and slice_size < max(tuned.values()):
+        slice_size = max(tuned.values())
+        print(f"Slice size raised to {slice_size} to match the tuned batch sizes.")
+
+    for channel, start, messages in ChannelScheduler(channels, max_channels, slice_size):
+        analyse_slice(analyser, channel, start, messages)
+        if channel.is_done():
+            finish_channel(channel)
+    preprocessor.save() # rewrites the whole token cache, so only once per run
+    analyser.clear_models()
+
+    # Throughput statistics
+    channels = [channel for channel in channels if channel.message_count]
+    if not channels:
+        print("No channels to analyse. Exiting.")
+        return
+    stats = pd.DataFrame({
+        "Channel": [channel.name for channel in channels],
+        "Messages": [channel.message_count for channel in channels],
+        "Seconds": [round(channel.processing_time, 2) for channel in channels],
+        "Messages/sec": [round(channel.throughput(), 2) for channel in channels],
+    })
+    print(stats.to_string(index=False))
+    stats_file = os.path.join(os.getcwd(), "Output", "channel_stats.csv")
+    display_output(stats, stats_file, sep="|")
+    print(f"Analysis complete. Channel statistics saved in {stats_file}")
+def analyse_slice(analyser: Analyser, channel: Channel, start: int, messages: list):
+    """Runs every model on a slice of a channel's messages and stores the results in the channel."""
+    time_started = time.perf_counter()
+    if channel.index is None: # the embedding index is only opened once the channel becomes active
+        channel.index = EmbeddingIndex(os.path.join(channel.output_dir, "embeddings"))
+        channel.index.create(channel.message_count, analyser.embedding_model.config.hidden_size,
+                             Analyser.EMBEDDING_MODEL, [message.text for message in channel.message_list])
+
+    texts = [message.text for message in messages]
+    sentiments = []
+    for _, batch in iterate_batches(texts, analyser.batch_sizes["sentiment"]):
+        sentiments.extend(analyser.sentiment_analysis_batch(batch))
+    topics = []
+    for _, batch in iterate_batches(texts, analyser.batch_sizes["topic"]):
+        topics.extend(analyser.classify_topic_batch(batch))
+    for position, batch in iterate_batches(texts, analyser.batch_sizes["embedding"]):
+        channel.index.add(start + position, analyser.embed(batch))
+
+    for message, sentiment, topic in zip(messages, sentiments, topics):
+        message.assign_new_labels(topic, sentiment, message.sensitive_topic)
+        channel.data["Date"].append(message.date)
+        channel.data["Semantic Tag"].append(message.sentiment)
+        channel.data["Label"].append(message.topic)
+    channel.processing_time += time.perf_counter() - time_started
+def finish_channel(channel: Channel):
+    """Saves the output.csv, the embedding index and the graphs of a finished channel."""
+    channel.index.close()
+    data = pd.DataFrame(channel.data)
+    display_output(data, os.path.join(channel.output_dir, "output.csv"), sep="|")
+
+    graphs = argparse.Namespace(general_timeline=True, topic_dynamics_timeline=True, general_histogram=True,
+                                topic_frequency_hist=True, topic_timeline=None, topic_histogram=None)
+    display_graph(data, graphs, topic_list=list(data['Label'].unique()), output_dir=channel.output_dir)
+    plt.close('all') # dozens of channels would otherwise keep all their figures in memory
+
+    channel.release()
+
+    print(f"Channel {channel.name}: {channel.message_count} messages in {channel.processing_time:.1f}s "
+          f"({channel.throughput():.2f} messages/sec). Results saved in {channel.output_dir}")
 def display_output(data:pd.DataFrame,output_file, sep):
     """
     Create the output.csv file
@@ -124,7 +309,7 @@ def display_output(data:pd.DataFrame,output_file, sep):
     # Create a DataFrame and save it to a CSV file
     displayer = Displayer(data)
     displayer.create_csv(output_file,sep)
-def display_graph(data: pd.DataFrame, args, topic_list=None):
+def display_graph(data: pd.DataFrame, args, topic_list=None, aggregation=None, output_dir=None):
     """
     Handles graph creation and visualization logic.
      Args:
@@ -132,6 +317,9 @@ def display_graph(data: pd.DataFrame, args, topic_list=None):
         args: Parsed arguments specifying which graphs to create.
         topic_list (list, optional): List of topics for topic-specific visualizations.
                                      Defaults to None.
+        aggregation (dict, optional): Time-bucketed data from the Aggregator, used by the timelines.
+                                      Computed from data if not provided.
+        output_dir (str, optional): Where the graphs are saved. Defaults to the "Output" folder.
 
     The function creates and saves:
         - General timeline
@@ -141,12 +329,13 @@ def display_graph(data: pd.DataFrame, args, topic_list=None):
         - Topic-specific timelines and histograms
     """
     displayer = Displayer(data)
-    output_dir = os.path.join(os.getcwd(), "Output")  # Ensure files are saved in the "Output" folder
+    if output_dir is None:
+        output_dir = os.path.join(os.getcwd(), "Output")  # Ensure files are saved in the "Output" folder
     os.makedirs(output_dir, exist_ok=True)
 
     if args.general_timeline:
         print("Creating general timeline...")
-        plt_obj = displayer.create_general_timeline(data)
+        plt_obj = displayer.create_general_timeline(data, aggregation)
         output_path = os.path.join(output_dir, "general_timeline.png")
         if plt_obj:
             plt_obj.savefig(output_path)
@@ -166,7 +355,7 @@ def display_graph(data: pd.DataFrame, args, topic_list=None):
         print("Creating topic timeline...")
         if topic_list is None:
             topic_list = list(data['Label'].unique())
-        plt_obj = displayer.create_topic_dynamics_timeline(topic_list, data)
+        plt_obj = displayer.create_topic_dynamics_timeline(topic_list, data, aggregation)
         output_path = os.path.join(output_dir, "topic_timeline.png")
         if plt_obj:
             plt_obj.savefig(output_path)
@@ -202,6 +391,61 @@ def display_graph(data: pd.DataFrame, args, topic_list=None):
             print(f"Topic histogram for {args.topic_histogram} saved at {output_path}")
         else:
             print(f"Failed to create topic histogram for {args.topic_histogram}.")
+def search_messages(query: str, k: int, data: pd.DataFrame, output_dir: str):
+    """
+    Prints the k messages whose embeddings are the most similar to the query.
+
+    Args:
+        query (str): The text to search for.
+        k (int): Number of messages to show.
+        data (pd.DataFrame): The csv output, used to show the date and topic of each match.
+        output_dir (str): The folder containing the csv output and the embedding index.
+    """
+    index = EmbeddingIndex(os.path.join(output_dir, "embeddings"))
+    if not index.load():
+        print("Embedding index not found. Please run analysis first.")
+        return
+    if index.meta["count"] != len(data):
+        print(f"The embedding index has {index.meta['count']} messages but the csv output has {len(data)} rows. "
+              f"Please run analysis again.")
+        return
+
+    analyser = Analyser()
+    analyser.load_embedding_model()
+    query_vector = analyser.embed([Preprocessor.normalise(query)])[0]
+    analyser.clear_models()
+
+    rows, scores = index.search(query_vector, k)
+    for row, score in zip(rows, scores):
+        print(f"[{score:.3f}] {data['Date'][row]} | {data['Label'][row]} | {index.text(row)}")
+def relabel_topics(labels: list, data: pd.DataFrame, output_dir: str) -> pd.DataFrame:
+    """
+    Reassigns the 'Label' column by similarity between the saved message embeddings and the label embeddings.
+
+    Args:
+        labels (list): The new list of topics.
+        data (pd.DataFrame): The csv output.
+        output_dir (str): The folder containing the csv output and the embedding index.
+
+    Returns:
+        pd.DataFrame: The data with the new labels, or an empty DataFrame if the index does not match the data.
+    """
+    index = EmbeddingIndex(os.path.join(output_dir, "embeddings"))
+    if not index.load():
+        print("Embedding index not found. Please run analysis first.")
+        return pd.DataFrame()
+    if index.meta["count"] != len(data):
+        print(f"The embedding index has {index.meta['count']} messages but the csv output has {len(data)} rows. "
+              f"Please run analysis again.")
+        return pd.DataFrame()
+
+    analyser = Analyser()
+    analyser.load_embedding_model()
+    prototypes = analyser.embed_labels(labels)
+    analyser.clear_models()
+
+    data['Label'] = index.assign_labels(prototypes, labels)
+    return data
 
 
 def main():
@@ -210,12 +454,18 @@ def main():
 
     # Default output file
     output_dir = os.path.join(os.getcwd(), "Output")
-    output_file = os.path.join(output_dir, "output.csv")
     os.makedirs(output_dir, exist_ok=True)
+    if getattr(args, 'channel', None): # outputs of a multi-channel run are saved per channel
+        output_dir = os.path.join(output_dir, args.channel)
+    output_file = os.path.join(output_dir, "output.csv")
+
+    if args.command == 'run' and args.channels:  # One subfolder of HTML files per channel
+        print("Starting multi-channel analysis...")
+        run_channels(args.channels, args.restriction, args.max_channels, args.slice_size, create_autotuner(args))
 
-    if args.command == 'run':  # Automatically process all HTML files in the Data folder
+    elif args.command == 'run':  # Automatically process all HTML files in the Data folder
         print("Starting analysis...")
-        data = run_analysis(restriction=args.restriction)
+        data = run_analysis(restriction=args.restriction, autotuner=create_autotuner(args))
 
         if data.empty:
             print("No data to process. Exiting.")
@@ -226,14 +476,44 @@ def main():
 
     elif args.command == 'visualize':  # Visualization logic
         if os.path.exists(output_file):
-            print(f"Loading data from {output_file}...")
-            data = pd.read_csv(output_file, sep="|")
-            topic_list = list(data['Label'].unique())
-            display_graph(data, args, topic_list=topic_list)
+            # The timelines are built from time buckets, read from the csv in chunks
+            aggregation = None
+            if args.general_timeline or args.topic_dynamics_timeline:
+                print(f"Aggregating data from {output_file}...")
+                aggregation = Aggregator(output_file).aggregate()
+                if not aggregation:
+                    print("No data to visualize. Exiting.")
+                    return
+
+            # The remaining graphs need the whole DataFrame
+            if args.general_histogram or args.topic_timeline or args.topic_histogram or args.topic_frequency_hist:
+                print(f"Loading data from {output_file}...")
+                data = pd.read_csv(output_file, sep="|")
+                topic_list = list(data['Label'].unique())
+            else:
+                data = pd.DataFrame()
+                topic_list = list(aggregation['topics'].columns) if aggregation else []
+            display_graph(data, args, topic_list=topic_list, aggregation=aggregation, output_dir=output_dir)
         else:
             print(f"CSV output file not found: {output_file}. Please run analysis first.")
+    elif args.command in ('search', 'relabel'):
+        if not os.path.exists(output_file):
+            print(f"CSV output file not found: {output_file}. Please run analysis first.")
+            return
+        data = pd.read_csv(output_file, sep="|")
+
+        if args.command == 'search':
+            search_messages(args.query, args.top, data, output_dir)
+        else:
+            print(f"Relabelling topics: {', '.join(args.labels)}")
+            data = relabel_topics(args.labels, data, output_dir)
+            if data.empty:
+                return
+            display_output(data, output_file, sep="|")
+            print(f"Relabelling complete. Results saved in {output_file}")
     else:
-        print("Invalid command. Use 'run' to start the analysis or 'visualize' to create graphs.")
+        print("Invalid command. Use 'run' to start the analysis, 'visualize' to create graphs, "
+              "'search' to find messages or 'relabel' to change the topics.")
 
 
 if __name__ == "__main__":